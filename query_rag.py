@@ -2,31 +2,30 @@ from __future__ import annotations
 
 from typing import Iterable
 
-from rag_pipeline import collect_chunk_metadata, query_rag, summarise_hits
+from rag_pipeline import query_rag
 
 
 def ask_question(question: str, k: int = 5) -> None:
     print("🔍 Вопрос:", question)
     try:
-        answer, chunks = query_rag(question, top_k=k)
+        result = query_rag(question, top_k=k)
     except FileNotFoundError as exc:
         print(f'❌ {exc}')
         return
 
-    if not chunks:
+    if not result.chunks:
         print("⚠️ Подходящие документы не найдены. Попробуйте переформулировать запрос.")
         return
 
-    hits = summarise_hits(chunks)
     print("📚 Найдены совпадения в документах:")
-    for name, count in hits.items():
+    for name, count in result.hits.items():
         print(f" • {name}: {count} фрагмент(ов)")
 
     print("\n🤖 Ответ:")
-    print(answer)
+    print(result.answer)
 
     print("\n🔎 Источники:")
-    for chunk in collect_chunk_metadata(chunks):
+    for chunk in result.sources:
         name = chunk.get("document_name") or "Неизвестный документ"
         page = chunk.get("page_number")
         page_info = f", страница {page}" if page else ""
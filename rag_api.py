@@ -1,24 +1,49 @@
 from __future__ import annotations
 
-from typing import List, Optional, Union
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Union
 
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+
+from rag_pipeline import (
+    RagResult,
+    get_embeddings,
+    get_llm,
+    get_vector_store,
+    keyword_sources,
+    query_rag_batch,
+    query_rag_tasks,
+)
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+    # Pay for client construction and index loading at boot, not on the first request.
+    get_embeddings()
+    get_llm()
+    try:
+        get_vector_store()
+    except FileNotFoundError as exc:
+        print(f"⚠️ {exc}")
+    yield
 
-from rag_pipeline import collect_chunk_metadata, query_rag
 
-app = FastAPI(title="KZ Legal RAG", version="0.1.0")
+app = FastAPI(title="KZ Legal RAG", version="0.1.0", lifespan=lifespan)
 
 
 class QuestionPayload(BaseModel):
     question_id: int
     question: str
-    top_k: Optional[int] = None
+    top_k: Optional[int] = Field(default=None, ge=1)
 
 
 class QuestionsBatch(BaseModel):
     questions: List[QuestionPayload]
-    default_top_k: Optional[int] = None
+    default_top_k: Optional[int] = Field(default=None, ge=1)
 
 
 class RelevantChunk(BaseModel):
@@ -35,11 +60,24 @@ class QueryResponse(BaseModel):
     answer: AnswerType
 
 
+class KeywordHits(BaseModel):
+    question_id: int
+    relevant_chunks: List[RelevantChunk]
+
+
+_NUMERIC_LEADS = frozenset("+-.,0123456789")
+_DECIMAL_COMMA = str.maketrans(",", ".")
+
+
 def _coerce_answer(raw_answer: str) -> AnswerType:
     stripped = raw_answer.strip()
     if not stripped:
         return ""
 
+    # Most answers are prose; only text that starts like a number is worth parsing.
+    if stripped[0] not in _NUMERIC_LEADS:
+        return stripped
+
     try:
         integer = int(stripped)
         return integer
@@ -47,7 +85,7 @@ def _coerce_answer(raw_answer: str) -> AnswerType:
         pass
 
     try:
-        floating = float(stripped.replace(",", "."))
+        floating = float(stripped.translate(_DECIMAL_COMMA))
         return floating
     except ValueError:
         pass
@@ -55,32 +93,91 @@ def _coerce_answer(raw_answer: str) -> AnswerType:
     return stripped
 
 
+def _to_response(item: QuestionPayload, result: RagResult) -> QueryResponse:
+    return QueryResponse(
+        question_id=item.question_id,
+        relevant_chunks=[RelevantChunk(**chunk) for chunk in result.sources],
+        answer=_coerce_answer(result.answer),
+    )
+
+
+def _event(stage: str, model: BaseModel) -> str:
+    return json.dumps({"stage": stage, **model.model_dump()}, ensure_ascii=False) + "\n"
+
+
+def _error_event(question_id: int, exc: BaseException) -> str:
+    error = {"stage": "error", "question_id": question_id, "detail": str(exc)}
+    return json.dumps(error, ensure_ascii=False) + "\n"
+
+
+async def _stream_answers(
+    questions: List[QuestionPayload], fallback_k: int
+) -> AsyncIterator[str]:
+    requests = [(item.question, item.top_k or fallback_k) for item in questions]
+    # Answers start right away; duplicate questions share one future.
+    waiting: Dict[asyncio.Future[RagResult], List[QuestionPayload]] = {}
+    for item, future in zip(questions, query_rag_tasks(requests)):
+        waiting.setdefault(future, []).append(item)
+    try:
+        # Keyword hits need neither an embedding nor the LLM, so they arrive while
+        # the answers are still being retrieved and generated.
+        keyword_hits = await asyncio.gather(
+            *(asyncio.to_thread(keyword_sources, question, top_k) for question, top_k in requests),
+            return_exceptions=True,
+        )
+        for item, sources in zip(questions, keyword_hits):
+            if isinstance(sources, BaseException):
+                yield _error_event(item.question_id, sources)
+                continue
+            hits = KeywordHits(
+                question_id=item.question_id,
+                relevant_chunks=[RelevantChunk(**chunk) for chunk in sources],
+            )
+            yield _event("keyword", hits)
+
+        while waiting:
+            done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                for item in waiting.pop(future):
+                    if future.exception() is not None:
+                        yield _error_event(item.question_id, future.exception())
+                    else:
+                        yield _event("final", _to_response(item, future.result()))
+    finally:
+        for future in waiting:
+            future.cancel()
+
+
 @app.post("/query", response_model=List[QueryResponse])
-def query_endpoint(payload: QuestionsBatch) -> List[QueryResponse]:
+async def query_endpoint(payload: QuestionsBatch) -> List[QueryResponse]:
     if not payload.questions:
         raise HTTPException(status_code=400, detail="Payload must contain at least one question")
 
-    responses: List[QueryResponse] = []
     fallback_k = payload.default_top_k or 5
+    requests = [(item.question, item.top_k or fallback_k) for item in payload.questions]
+    try:
+        results = await query_rag_batch(requests)
+    except FileNotFoundError as exc:
+        raise HTTPException(status_code=503, detail=str(exc))
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
+
+    return [_to_response(item, result) for item, result in zip(payload.questions, results)]
 
-    for item in payload.questions:
-        top_k = item.top_k or fallback_k
-        try:
-            answer, chunks = query_rag(item.question, top_k=top_k)
-        except FileNotFoundError as exc:
-            raise HTTPException(status_code=503, detail=str(exc))
-        except Exception as exc:
-            raise HTTPException(status_code=500, detail=str(exc))
-        relevant_chunks = [RelevantChunk(**chunk) for chunk in collect_chunk_metadata(chunks)]
-        responses.append(
-            QueryResponse(
-                question_id=item.question_id,
-                relevant_chunks=relevant_chunks,
-                answer=_coerce_answer(answer),
-            )
-        )
 
-    return responses
+@app.post("/query/stream")
+async def query_stream_endpoint(payload: QuestionsBatch) -> StreamingResponse:
+    if not payload.questions:
+        raise HTTPException(status_code=400, detail="Payload must contain at least one question")
+    try:
+        get_vector_store()
+    except FileNotFoundError as exc:
+        raise HTTPException(status_code=503, detail=str(exc))
+
+    fallback_k = payload.default_top_k or 5
+    return StreamingResponse(
+        _stream_answers(payload.questions, fallback_k), media_type="application/x-ndjson"
+    )
 
 
 @app.get("/health")
@@ -1,25 +1,51 @@
+import argparse
+import asyncio
+import hashlib
+import os
+import random
 import shutil
+import sqlite3
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import closing
+from functools import cache
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Optional, Set, Tuple
 
+import faiss
+import numpy as np
+import tiktoken
 from langchain_core.documents import Document
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_chroma import Chroma
-from langchain_openai import OpenAIEmbeddings
+from openai import APIConnectionError, AsyncOpenAI, InternalServerError, RateLimitError
+from semantic_text_splitter import TextSplitter
 
 from api import openai_key
 
 try:
-    from pypdf import PdfReader
+    import pymupdf
 except ImportError:  # pragma: no cover - handled at runtime
-    PdfReader = None
+    pymupdf = None
 
 BASE_DIR = Path(__file__).resolve().parent
 DATA_DIR = BASE_DIR / "data" / "laws"
 PERSIST_DIR = BASE_DIR / "chroma_db" / "kz_legal_codes"
-COLLECTION_NAME = "kz_legal_codes"
+INDEX_FILE = PERSIST_DIR / "faiss.index"
+CHUNKS_DB_FILE = PERSIST_DIR / "chunks.sqlite3"
+VECTORS_FILE = PERSIST_DIR / "vectors.npy"
+METADATA_COLUMNS = ("document_name", "page_number", "source_path", "source_type", "start_index")
 SUPPORTED_TEXT_EXTENSIONS = {".txt", ".md"}
 MIN_CHARS_PER_PAGE = 50
+MAX_PDF_WORKERS = 6
+PDF_WORKERS = min(os.cpu_count() or 1, MAX_PDF_WORKERS)
+CHUNK_SIZE = 1200
+CHUNK_OVERLAP = 200
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIM = 1536
+HNSW_NEIGHBOURS = 32
+EMBEDDING_BATCH_SIZE = 2048
+EMBEDDING_BATCH_TOKENS = 300_000
+MAX_CONCURRENT_EMBEDDINGS = 35
+EMBEDDING_RETRIES = 5
+HASH_BLOCK_SIZE = 1 << 20
 
 
 def _relative_path(path: Path) -> str:
@@ -43,107 +69,313 @@ def load_text_document(path: Path) -> List[Document]:
     return [Document(page_content=text, metadata=metadata)]
 
 
-def load_pdf_document(path: Path) -> List[Document]:
-    if PdfReader is None:
+def _extract_range(args: Tuple[str, int, int]) -> List[Tuple[int, str]]:
+    path, start, stop = args
+    # One open per range amortises parsing the document structure across its pages.
+    pages: List[Tuple[int, str]] = []
+    with pymupdf.open(path) as doc:
+        for page_index in range(start, stop):
+            page = doc[page_index]
+            # Blank and scanned pages reference no fonts, so they cannot yield text.
+            if not page.get_fonts():
+                continue
+            pages.append((page_index + 1, page.get_text("text")))
+    return pages
+
+
+def load_pdf_document(path: Path, executor: Optional[Executor] = None) -> List[Document]:
+    if pymupdf is None:
         raise RuntimeError(
-            "pypdf is required to read PDF files. Install it with `pip install pypdf`."
+            "PyMuPDF is required to read PDF files. Install it with `pip install pymupdf`."
         )
 
-    reader = PdfReader(str(path))
+    with pymupdf.open(str(path)) as doc:
+        page_count = doc.page_count
+    step = max(1, page_count // (4 * PDF_WORKERS))
+    tasks = [
+        (str(path), start, min(start + step, page_count))
+        for start in range(0, page_count, step)
+    ]
+    if executor is None or len(tasks) <= 1:
+        # A single range gains nothing from another process.
+        ranges = [_extract_range(task) for task in tasks]
+    else:
+        # Page extraction is CPU-bound, so each worker process parses its own page range.
+        ranges = list(executor.map(_extract_range, tasks))
+
     documents: List[Document] = []
-    for page_index, page in enumerate(reader.pages, start=1):
-        text = page.extract_text() or ""
+    for page_number, text in (page for pages in ranges for page in pages):
         text = text.strip()
         if len(text) < MIN_CHARS_PER_PAGE:
             continue
         metadata = {
             "document_name": path.name,
             "source_path": _relative_path(path),
-            "page_number": page_index,
+            "page_number": page_number,
             "source_type": "pdf",
         }
         documents.append(Document(page_content=text, metadata=metadata))
     return documents
 
 
-def load_legal_documents() -> List[Document]:
+def _file_digest(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as fh:
+        for block in iter(lambda: fh.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_legal_documents(
+    known_hashes: Optional[Dict[str, str]] = None,
+) -> Tuple[List[Document], Dict[str, str]]:
     DATA_DIR.mkdir(parents=True, exist_ok=True)
+    known_hashes = known_hashes or {}
     documents: List[Document] = []
+    hashes: Dict[str, str] = {}
 
     if not any(DATA_DIR.iterdir()):
         print(f"⚠️ {DATA_DIR} is empty. Add legal documents (PDF/TXT) and rerun the script.")
-        return documents
+        return documents, hashes
 
-    for file_path in sorted(DATA_DIR.rglob("*")):
-        if file_path.is_dir():
-            continue
+    executor: Optional[ProcessPoolExecutor] = None
+    try:
+        for file_path in sorted(DATA_DIR.rglob("*")):
+            if file_path.is_dir():
+                continue
 
-        suffix = file_path.suffix.lower()
-        try:
-            if suffix == ".pdf":
-                loaded = load_pdf_document(file_path)
-            elif suffix in SUPPORTED_TEXT_EXTENSIONS:
-                loaded = load_text_document(file_path)
-            else:
+            suffix = file_path.suffix.lower()
+            if suffix != ".pdf" and suffix not in SUPPORTED_TEXT_EXTENSIONS:
                 print(f"⚠️ Skipping unsupported file: {file_path.name}")
                 continue
-        except Exception as exc:  # pragma: no cover - runtime feedback
-            print(f"❌ Failed to load {file_path.name}: {exc}")
-            continue
 
-        if not loaded:
-            print(f"⚠️ No textual content extracted from {file_path.name}")
-            continue
+            source_path = _relative_path(file_path)
+            digest = _file_digest(file_path)
+            if known_hashes.get(source_path) == digest:
+                hashes[source_path] = digest
+                print(f"⏭️ {file_path.name}: unchanged")
+                continue
 
-        documents.extend(loaded)
-        print(f"📄 {file_path.name}: added {len(loaded)} page(s)")
+            try:
+                if suffix == ".pdf":
+                    # One pool serves every PDF, so workers start once per build.
+                    if executor is None:
+                        executor = ProcessPoolExecutor(max_workers=PDF_WORKERS)
+                    loaded = load_pdf_document(file_path, executor)
+                else:
+                    loaded = load_text_document(file_path)
+            except Exception as exc:  # pragma: no cover - runtime feedback
+                print(f"❌ Failed to load {file_path.name}: {exc}")
+                continue
 
-    return documents
+            hashes[source_path] = digest
+            if not loaded:
+                print(f"⚠️ No textual content extracted from {file_path.name}")
+                continue
 
+            documents.extend(loaded)
+            print(f"📄 {file_path.name}: added {len(loaded)} page(s)")
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
-def build_vector_store() -> None:
-    documents = load_legal_documents()
-    if not documents:
-        print("❌ No documents were loaded. Nothing to index.")
-        return
+    return documents, hashes
 
-    print(f"\n📊 Summary: {len(documents)} document page(s) ready for chunking")
 
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1200,
-        chunk_overlap=200,
-        add_start_index=True,
-    )
-    chunks = splitter.split_documents(documents)
-    print(f"✂️ Split into {len(chunks)} chunks")
+def split_documents(documents: List[Document]) -> List[Document]:
+    splitter = TextSplitter(CHUNK_SIZE, overlap=CHUNK_OVERLAP)
+    chunks: List[Document] = []
+    for document in documents:
+        # chunk_indices yields character offsets, matching LangChain's start_index.
+        for start_index, text in splitter.chunk_indices(document.page_content):
+            metadata = {**document.metadata, "start_index": start_index}
+            chunks.append(Document(page_content=text, metadata=metadata))
+    return chunks
+
+
+async def _request_embeddings(client: AsyncOpenAI, batch: List[str]) -> List[List[float]]:
+    response = await client.embeddings.create(model=EMBEDDING_MODEL, input=batch)
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+async def _embed_batch(
+    client: AsyncOpenAI, semaphore: asyncio.Semaphore, batch: List[str]
+) -> List[List[float]]:
+    async with semaphore:
+        delay = 1.0
+        for _ in range(EMBEDDING_RETRIES - 1):
+            try:
+                return await _request_embeddings(client, batch)
+            except (RateLimitError, APIConnectionError, InternalServerError) as exc:  # pragma: no cover
+                # Jitter keeps throttled batches from retrying in lockstep.
+                wait = delay * (1 + random.random())
+                print(f"⚠️ Embedding batch failed ({exc}), retrying in {wait:.1f}s")
+                await asyncio.sleep(wait)
+                delay *= 2
+        return await _request_embeddings(client, batch)
+
+
+@cache
+def _token_encoding() -> tiktoken.Encoding:
+    # Loading the BPE ranks is far costlier than encoding, so it happens at most once
+    # per process, and never in PDF workers or on import.
+    return tiktoken.encoding_for_model(EMBEDDING_MODEL)
+
+
+def _token_batches(texts: List[str]) -> List[List[str]]:
+    token_counts = [
+        len(tokens) for tokens in _token_encoding().encode_batch(texts, disallowed_special=())
+    ]
+    batches: List[List[str]] = []
+    batch: List[str] = []
+    batch_tokens = 0
+    for text, tokens in zip(texts, token_counts):
+        if batch and (
+            len(batch) == EMBEDDING_BATCH_SIZE or batch_tokens + tokens > EMBEDDING_BATCH_TOKENS
+        ):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(text)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
 
-    embeddings = OpenAIEmbeddings(
-        model="text-embedding-3-small",
-        api_key=openai_key,
-        chunk_size=80,
+
+async def _embed_all(texts: List[str]) -> List[List[float]]:
+    batches = _token_batches(texts)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_EMBEDDINGS)
+    # Retries are handled per batch above, so the client's own retry loop is disabled.
+    async with AsyncOpenAI(api_key=openai_key, max_retries=0) as client:
+        # gather keeps results in batch order, so vectors line up with texts.
+        results = await asyncio.gather(
+            *(_embed_batch(client, semaphore, batch) for batch in batches)
+        )
+    return [vector for batch in results for vector in batch]
+
+
+def embed_texts(texts: List[str]) -> List[List[float]]:
+    return asyncio.run(_embed_all(texts))
+
+
+def _read_manifest() -> Dict[str, str]:
+    if not CHUNKS_DB_FILE.exists() or not VECTORS_FILE.exists():
+        return {}
+    with closing(sqlite3.connect(CHUNKS_DB_FILE)) as conn:
+        try:
+            return dict(conn.execute("SELECT source_path, sha256 FROM files"))
+        except sqlite3.OperationalError:  # built before the manifest existed
+            return {}
+
+
+def _load_stored_chunks(source_paths: Set[str]) -> Tuple[List[Document], np.ndarray]:
+    if not source_paths:
+        return [], np.empty((0, EMBEDDING_DIM), dtype="float32")
+
+    placeholders = ", ".join("?" * len(source_paths))
+    with closing(sqlite3.connect(CHUNKS_DB_FILE)) as conn:
+        rows = conn.execute(
+            f"SELECT id, page_content, {', '.join(METADATA_COLUMNS)} FROM chunks "
+            f"WHERE source_path IN ({placeholders}) ORDER BY id",
+            sorted(source_paths),
+        ).fetchall()
+    chunks = [
+        Document(page_content=row[1], metadata=dict(zip(METADATA_COLUMNS, row[2:])))
+        for row in rows
+    ]
+    vectors = np.load(VECTORS_FILE)[[row[0] for row in rows]]
+    return chunks, vectors
+
+
+def _write_chunks(chunks: List[Document], hashes: Dict[str, str]) -> None:
+    rows = (
+        (vector_id, chunk.page_content, *(chunk.metadata.get(column) for column in METADATA_COLUMNS))
+        for vector_id, chunk in enumerate(chunks)
     )
+    with closing(sqlite3.connect(CHUNKS_DB_FILE)) as conn, conn:
+        conn.execute(
+            "CREATE TABLE chunks ("
+            "id INTEGER PRIMARY KEY, page_content TEXT NOT NULL, document_name TEXT, "
+            "page_number INTEGER, source_path TEXT, source_type TEXT, start_index INTEGER)"
+        )
+        conn.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        conn.execute(
+            "CREATE VIRTUAL TABLE chunks_fts USING fts5("
+            "page_content, content='chunks', content_rowid='id')"
+        )
+        conn.execute("INSERT INTO chunks_fts(chunks_fts) VALUES ('rebuild')")
+        conn.execute("CREATE TABLE files (source_path TEXT PRIMARY KEY, sha256 TEXT NOT NULL)")
+        conn.executemany("INSERT INTO files VALUES (?, ?)", hashes.items())
+
+
+def build_vector_store(rebuild: bool = False) -> None:
+    manifest = {} if rebuild else _read_manifest()
+    documents, hashes = load_legal_documents(manifest)
+    unchanged = {path for path, digest in manifest.items() if hashes.get(path) == digest}
+    if manifest and not documents and unchanged == set(manifest) == set(hashes):
+        print("✅ Vector store is up to date. Nothing to index.")
+        return
+
+    print(f"\n📊 Summary: {len(documents)} new or changed document page(s) ready for chunking")
+
+    new_chunks = split_documents(documents)
+    print(f"✂️ Split into {len(new_chunks)} chunks")
+
+    new_vectors = np.empty((0, EMBEDDING_DIM), dtype="float32")
+    if new_chunks:
+        texts = [chunk.page_content for chunk in new_chunks]
+        new_vectors = np.asarray(embed_texts(texts), dtype="float32")
+        faiss.normalize_L2(new_vectors)
+        print(f"🧮 Embedded {len(new_vectors)} chunks")
+
+    # Unchanged files reuse their stored vectors instead of being embedded again.
+    kept_chunks, kept_vectors = _load_stored_chunks(unchanged)
+    if kept_chunks:
+        print(f"♻️ Reused {len(kept_chunks)} stored chunks")
+    chunks = kept_chunks + new_chunks
+    vectors = np.ascontiguousarray(np.concatenate([kept_vectors, new_vectors]))
+    if not chunks:
+        if manifest and PERSIST_DIR.exists():
+            # Every indexed file is gone; leaving the old store would keep serving it.
+            shutil.rmtree(PERSIST_DIR)
+            print("🗑️ All indexed documents were removed. Cleared existing database")
+            return
+        print("❌ No documents were loaded. Nothing to index.")
+        return
+
+    # 8-bit scalar quantisation keeps one byte per dimension instead of four.
+    index = faiss.IndexHNSWSQ(EMBEDDING_DIM, faiss.ScalarQuantizer.QT_8bit, HNSW_NEIGHBOURS)
+    index.train(vectors)
+    index.add(vectors)
 
     if PERSIST_DIR.exists():
         shutil.rmtree(PERSIST_DIR)
         print("🗑️ Cleared existing database")
     PERSIST_DIR.mkdir(parents=True, exist_ok=True)
 
-    vector_store = Chroma.from_documents(
-        documents=chunks,
-        embedding=embeddings,
-        collection_name=COLLECTION_NAME,
-        persist_directory=str(PERSIST_DIR),
-    )
+    faiss.write_index(index, str(INDEX_FILE))
+    np.save(VECTORS_FILE, vectors)
+    _write_chunks(chunks, hashes)
 
-    print(f"✅ Successfully stored {len(chunks)} vectors")
+    print(f"✅ Successfully stored {index.ntotal} vectors")
     print(f"💾 DB path: {PERSIST_DIR}")
 
     try:
-        sanity = vector_store.similarity_search("административное правонарушение", k=3)
-        print("🔎 Sanity search (top documents):", [doc.metadata.get("document_name") for doc in sanity])
+        query = np.asarray(embed_texts(["административное правонарушение"]), dtype="float32")
+        _, ids = index.search(query, 3)
+        print(
+            "🔎 Sanity search (top documents):",
+            [chunks[i].metadata.get("document_name") for i in ids[0] if i != -1],
+        )
     except Exception as exc:  # pragma: no cover - runtime feedback
         print("⚠️ Sanity search failed:", exc)
 
 
 if __name__ == "__main__":
-    build_vector_store()
+    parser = argparse.ArgumentParser(description="Build or update the legal-code vector store.")
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="re-embed every document instead of only new or changed files",
+    )
+    build_vector_store(rebuild=parser.parse_args().rebuild)
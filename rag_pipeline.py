@@ -1,20 +1,70 @@
 from __future__ import annotations
 
-from collections import defaultdict
+import asyncio
+import hashlib
+import re
+import sqlite3
+import threading
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, List, Tuple
+from types import MappingProxyType
+from typing import Dict, List, Mapping, NamedTuple, Sequence, Tuple
 
-from langchain_chroma import Chroma
+import faiss
+import httpx
+import numpy as np
 from langchain_core.documents import Document
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 
 from api import openai_key
 
+try:
+    import diskcache
+except ImportError:  # pragma: no cover - persistence is optional
+    diskcache = None
+
+try:
+    import h2  # noqa: F401 - enables HTTP/2 in httpx
+except ImportError:  # pragma: no cover - falls back to HTTP/1.1 keep-alive
+    HTTP2_AVAILABLE = False
+else:
+    HTTP2_AVAILABLE = True
+
 BASE_DIR = Path(__file__).resolve().parent
 PERSIST_DIR = BASE_DIR / "chroma_db" / "kz_legal_codes"
-COLLECTION_NAME = "kz_legal_codes"
+INDEX_FILE = PERSIST_DIR / "faiss.index"
+CHUNKS_DB_FILE = PERSIST_DIR / "chunks.sqlite3"
+VECTORS_FILE = PERSIST_DIR / "vectors.npy"
+# Kept beside the store: question embeddings do not depend on the corpus and must survive rebuilds.
+QUERY_CACHE_DIR = BASE_DIR / "chroma_db" / "qcache"
+QUERY_CACHE_SIZE = 4096
+RESPONSE_CACHE_SIZE = 1024
+SEMANTIC_CACHE_THRESHOLD = 0.95
+METADATA_COLUMNS = ("document_name", "page_number", "source_path", "source_type", "start_index")
 DEFAULT_TOP_K = 5
+MAX_CONCURRENT_QUERIES = 35
+HTTP_TIMEOUT = 60.0
+FTS_MIN_TERM_LENGTH = 3
+RRF_K = 60
+HNSW_EF_SEARCH = 64
+FLAT_SEARCH_MAX_VECTORS = 50_000
+
+VectorStore = Tuple[faiss.Index | None, np.ndarray, sqlite3.Connection]
+
+
+Sources = Tuple[Mapping[str, object], ...]
+
+
+# Results are shared between cache hits, so every field is read-only.
+class RagResult(NamedTuple):
+    answer: str
+    chunks: Tuple[Document, ...]
+    sources: Sources
+    hits: Mapping[str, int]
+
 
 _PROMPT = ChatPromptTemplate.from_template(
     """Ты — юридический ассистент. Отвечай только на основе переданного контекста из нормативных актов РК.
@@ -32,9 +82,36 @@ _PROMPT = ChatPromptTemplate.from_template(
 Ответ:"""
 )
 
+_http_client: httpx.Client | None = None
 _embeddings: OpenAIEmbeddings | None = None
-_vector_store: Chroma | None = None
 _llm: ChatOpenAI | None = None
+_query_cache: "diskcache.Cache | None" = None
+_query_executor = ThreadPoolExecutor(
+    max_workers=MAX_CONCURRENT_QUERIES, thread_name_prefix="rag-query"
+)
+_keyword_executor = ThreadPoolExecutor(
+    max_workers=MAX_CONCURRENT_QUERIES, thread_name_prefix="rag-keyword"
+)
+
+# Answers keyed by (normalised question, top_k), least recently used first.
+_response_lock = threading.Lock()
+_responses: "OrderedDict[Tuple[str, int], RagResult]" = OrderedDict()
+
+# Normalised question vectors of answered queries, one flat index per top_k.
+_semantic_lock = threading.Lock()
+_semantic_indexes: Dict[int, faiss.IndexFlatIP] = {}
+_semantic_responses: Dict[int, List[RagResult]] = {}
+
+
+def get_http_client() -> httpx.Client:
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.Client(
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+            timeout=HTTP_TIMEOUT,
+        )
+    return _http_client
 
 
 def get_embeddings() -> OpenAIEmbeddings:
@@ -44,23 +121,59 @@ def get_embeddings() -> OpenAIEmbeddings:
             model="text-embedding-3-small",
             api_key=openai_key,
             chunk_size=80,
+            http_client=get_http_client(),
         )
     return _embeddings
 
 
-def get_vector_store() -> Chroma:
-    global _vector_store
-    if _vector_store is None:
-        if not PERSIST_DIR.exists():
-            raise FileNotFoundError(
-                f"Vector store directory {PERSIST_DIR} is missing. Run rag_data.py to build it."
-            )
-        _vector_store = Chroma(
-            collection_name=COLLECTION_NAME,
-            embedding_function=get_embeddings(),
-            persist_directory=str(PERSIST_DIR),
+def get_query_cache() -> "diskcache.Cache | None":
+    global _query_cache
+    if _query_cache is None and diskcache is not None:
+        _query_cache = diskcache.Cache(str(QUERY_CACHE_DIR))
+    return _query_cache
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _embed_cached(text_hash: str, text: str) -> Tuple[float, ...]:
+    cache = get_query_cache()
+    if cache is not None:
+        cached = cache.get(text_hash)
+        if cached is not None:
+            return cached
+
+    vector = tuple(get_embeddings().embed_query(text))
+    if cache is not None:
+        cache.set(text_hash, vector)
+    return vector
+
+
+def embed_question(question: str) -> Tuple[float, ...]:
+    text_hash = hashlib.sha256(question.encode("utf-8")).hexdigest()
+    return _embed_cached(text_hash, question)
+
+
+@lru_cache(maxsize=1)
+def _open_store() -> VectorStore:
+    if not all(path.exists() for path in (INDEX_FILE, VECTORS_FILE, CHUNKS_DB_FILE)):
+        raise FileNotFoundError(
+            f"Vector index {INDEX_FILE} is missing. Run rag_data.py to build it."
         )
-    return _vector_store
+    vectors = np.load(VECTORS_FILE, mmap_mode="r")
+    # Small corpora are served by the exact flat scan, so the HNSW index is never opened.
+    index = None
+    if len(vectors) > FLAT_SEARCH_MAX_VECTORS:
+        # MMAP_IFC maps the stored codes; plain IO_FLAG_MMAP only affects IVF inverted lists.
+        index = faiss.read_index(str(INDEX_FILE), faiss.IO_FLAG_MMAP_IFC)
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    # Read-only and shared by the query threads; sqlite serialises access itself.
+    connection = sqlite3.connect(
+        f"{CHUNKS_DB_FILE.as_uri()}?mode=ro", uri=True, check_same_thread=False
+    )
+    return index, vectors, connection
+
+
+def get_vector_store() -> VectorStore:
+    return _open_store()
 
 
 def get_llm() -> ChatOpenAI:
@@ -70,56 +183,213 @@ def get_llm() -> ChatOpenAI:
             model="gpt-4o-mini",
             api_key=openai_key,
             temperature=0,
+            http_client=get_http_client(),
         )
     return _llm
 
 
-def _format_context(chunks: List[Document]) -> str:
-    formatted_parts: List[str] = []
+def _build_response(chunks: List[Document]) -> Tuple[str, Sources, Mapping[str, int]]:
+    parts: List[str] = []
+    append = parts.append
+    seen = set()
+    sources: List[Mapping[str, object]] = []
+    hits: Dict[str, int] = defaultdict(int)
+
     for chunk in chunks:
-        name = chunk.metadata.get("document_name", "Неизвестный документ")
-        page = chunk.metadata.get("page_number")
-        page_info = f", страница {page}" if page else ""
-        formatted_parts.append(f"[{name}{page_info}]\n{chunk.page_content}")
-    return "\n\n".join(formatted_parts)
+        get = chunk.metadata.get
+        name = get("document_name")
+        page = get("page_number")
 
+        if parts:
+            append("\n\n")
+        append("[")
+        append("Неизвестный документ" if name is None else name)
+        if page:
+            append(", страница ")
+            append(str(page))
+        append("]\n")
+        append(chunk.page_content)
 
-def query_rag(question: str, top_k: int = DEFAULT_TOP_K) -> Tuple[str, List[Document]]:
-    vector_store = get_vector_store()
-    retrieved = vector_store.similarity_search(question, k=top_k)
+        hits["Unknown" if name is None else name] += 1
+        key = (name, page)
+        if key not in seen:
+            seen.add(key)
+            sources.append(MappingProxyType({"document_name": name, "page_number": page}))
 
-    if not retrieved:
-        return "Я не знаю", []
+    return "".join(parts), tuple(sources), MappingProxyType(dict(hits))
 
-    context = _format_context(retrieved)
-    message = _PROMPT.invoke({"context": context, "question": question})
-    answer = get_llm().invoke(message)
-    return answer.content.strip(), retrieved
 
+def _flat_top_k(vectors: np.ndarray, query: np.ndarray, top_k: int) -> np.ndarray:
+    scores = vectors @ query
+    if top_k < len(scores):
+        ids = np.argpartition(-scores, top_k)[:top_k]
+    else:
+        ids = np.arange(len(scores))
+    return ids[np.argsort(-scores[ids])]
 
-def collect_chunk_metadata(chunks: List[Document]) -> List[Dict[str, object]]:
-    seen = set()
-    structured: List[Dict[str, object]] = []
 
-    for chunk in chunks:
-        name = chunk.metadata.get("document_name")
-        page = chunk.metadata.get("page_number")
-        key = (name, page)
-        if key in seen:
-            continue
-        seen.add(key)
-        structured.append(
-            {
-                "document_name": name,
-                "page_number": page,
-            }
+def _fetch_chunks(connection: sqlite3.Connection, ids: Sequence[int]) -> List[Document]:
+    if not ids:
+        return []
+    placeholders = ", ".join("?" * len(ids))
+    rows = connection.execute(
+        f"SELECT id, page_content, {', '.join(METADATA_COLUMNS)} FROM chunks "
+        f"WHERE id IN ({placeholders})",
+        ids,
+    ).fetchall()
+    by_id = {row[0]: row for row in rows}
+    return [
+        Document(
+            page_content=by_id[vector_id][1],
+            metadata=dict(zip(METADATA_COLUMNS, by_id[vector_id][2:])),
         )
-    return structured
+        for vector_id in ids
+        if vector_id in by_id
+    ]
 
 
-def summarise_hits(chunks: List[Document]) -> Dict[str, int]:
-    counts: Dict[str, int] = defaultdict(int)
-    for chunk in chunks:
-        name = chunk.metadata.get("document_name", "Unknown")
-        counts[name] += 1
-    return dict(counts)
+def _vector_ids(query: np.ndarray, top_k: int) -> List[int]:
+    index, vectors, _ = get_vector_store()
+    # A BLAS matrix-vector product beats HNSW traversal on small corpora and is exact.
+    if index is None:
+        return [int(i) for i in _flat_top_k(vectors, query[0], top_k)]
+    _, found = index.search(query, top_k)
+    return [int(i) for i in found[0] if i != -1]
+
+
+# Memoised so /query/stream's early keyword hits and the final answer share one lookup.
+@lru_cache(maxsize=RESPONSE_CACHE_SIZE)
+def _keyword_ids(question: str, top_k: int) -> Tuple[int, ...]:
+    terms = [term for term in re.findall(r"\w+", question) if len(term) >= FTS_MIN_TERM_LENGTH]
+    if not terms:
+        return ()
+    _, _, connection = get_vector_store()
+    try:
+        rows = connection.execute(
+            "SELECT rowid FROM chunks_fts WHERE chunks_fts MATCH ? ORDER BY rank LIMIT ?",
+            (" OR ".join(f'"{term}"' for term in terms), top_k),
+        ).fetchall()
+    except sqlite3.OperationalError:  # store built before the keyword index existed
+        return ()
+    return tuple(row[0] for row in rows)
+
+
+def _fuse(rankings: List[Sequence[int]], top_k: int) -> List[int]:
+    # Reciprocal Rank Fusion; ties keep the order of the first ranking.
+    scores: Dict[int, float] = defaultdict(float)
+    for ranking in rankings:
+        for rank, vector_id in enumerate(ranking, start=1):
+            scores[vector_id] += 1.0 / (RRF_K + rank)
+    return sorted(scores, key=scores.__getitem__, reverse=True)[:top_k]
+
+
+def keyword_search(question: str, top_k: int = DEFAULT_TOP_K) -> List[Document]:
+    _, _, connection = get_vector_store()
+    return _fetch_chunks(connection, _keyword_ids(question, top_k))
+
+
+def keyword_sources(question: str, top_k: int = DEFAULT_TOP_K) -> Sources:
+    seen = set()
+    sources: List[Mapping[str, object]] = []
+    for chunk in keyword_search(question, top_k):
+        key = (chunk.metadata.get("document_name"), chunk.metadata.get("page_number"))
+        if key not in seen:
+            seen.add(key)
+            sources.append(MappingProxyType({"document_name": key[0], "page_number": key[1]}))
+    return tuple(sources)
+
+
+def _semantic_lookup(query: np.ndarray, top_k: int) -> RagResult | None:
+    with _semantic_lock:
+        index = _semantic_indexes.get(top_k)
+        if index is None or index.ntotal == 0:
+            return None
+        scores, ids = index.search(query, 1)
+        if scores[0][0] < SEMANTIC_CACHE_THRESHOLD:
+            return None
+        return _semantic_responses[top_k][ids[0][0]]
+
+
+def _semantic_store(query: np.ndarray, top_k: int, response: RagResult) -> None:
+    with _semantic_lock:
+        index = _semantic_indexes.get(top_k)
+        if index is None or index.ntotal >= RESPONSE_CACHE_SIZE:
+            index = _semantic_indexes[top_k] = faiss.IndexFlatIP(query.shape[1])
+            _semantic_responses[top_k] = []
+        index.add(query)
+        _semantic_responses[top_k].append(response)
+
+
+def _cached_query(key: str, question: str, top_k: int) -> RagResult:
+    # The normalised key only selects the cache slot; retrieval and the prompt see the
+    # caller's question, so abbreviations such as РК or НДС keep their case.
+    with _response_lock:
+        cached = _responses.get((key, top_k))
+        if cached is not None:
+            _responses.move_to_end((key, top_k))
+            return cached
+
+    response = _answer_question(question, top_k)
+    with _response_lock:
+        _responses[(key, top_k)] = response
+        if len(_responses) > RESPONSE_CACHE_SIZE:
+            _responses.popitem(last=False)
+    return response
+
+
+def _answer_question(question: str, top_k: int) -> RagResult:
+    query = np.asarray([embed_question(question)], dtype="float32")
+    faiss.normalize_L2(query)
+    cached = _semantic_lookup(query, top_k)
+    if cached is not None:
+        return cached
+
+    # Full-text search runs alongside the vector search; a semantic hit skips both.
+    keyword_ids = _keyword_executor.submit(_keyword_ids, question, top_k)
+    _, _, connection = get_vector_store()
+    fused = _fuse([_vector_ids(query, top_k), keyword_ids.result()], top_k)
+    retrieved = _fetch_chunks(connection, fused)
+    if retrieved:
+        context, sources, hits = _build_response(retrieved)
+        message = _PROMPT.invoke({"context": context, "question": question})
+        answer = get_llm().invoke(message).content.strip()
+        response = RagResult(answer, tuple(retrieved), sources, hits)
+    else:
+        response = RagResult("Я не знаю", (), (), MappingProxyType({}))
+    _semantic_store(query, top_k, response)
+    return response
+
+
+def _normalise_question(question: str) -> str:
+    return question.strip().lower()
+
+
+def _check_top_k(top_k: int) -> None:
+    # argpartition and SQLite's LIMIT both read a negative k as "almost everything".
+    if top_k < 1:
+        raise ValueError(f"top_k must be at least 1, got {top_k}")
+
+
+def query_rag(question: str, top_k: int = DEFAULT_TOP_K) -> RagResult:
+    _check_top_k(top_k)
+    return _cached_query(_normalise_question(question), question, top_k)
+
+
+def query_rag_tasks(requests: List[Tuple[str, int]]) -> List["asyncio.Future[RagResult]"]:
+    for _, top_k in requests:
+        _check_top_k(top_k)
+    keys = [(_normalise_question(question), top_k) for question, top_k in requests]
+    # Duplicates share one future instead of racing each other past the cache;
+    # the first spelling of each question is the one sent on.
+    loop = asyncio.get_running_loop()
+    futures: Dict[Tuple[str, int], "asyncio.Future[RagResult]"] = {}
+    for (key, top_k), (question, _) in zip(keys, requests):
+        if (key, top_k) not in futures:
+            futures[(key, top_k)] = loop.run_in_executor(
+                _query_executor, _cached_query, key, question, top_k
+            )
+    return [futures[key] for key in keys]
+
+
+async def query_rag_batch(requests: List[Tuple[str, int]]) -> List[RagResult]:
+    return list(await asyncio.gather(*query_rag_tasks(requests)))